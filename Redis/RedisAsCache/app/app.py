@@ -4,32 +4,62 @@
 # - City path: cached with TTL + jitter + dogpile + stale-on-error
 # - Lat/Lon path: bypasses geocoding; robust 502 mapping on upstream errors
 # - /stats and /healthz
+# - WARM_CITIES are pre-fetched concurrently at startup
 
 import os
+import math
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import Optional
 
 import httpx
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 
 from cache import (
     cached,
     cache_get,
     cache_set,
+    flush_stats,
     incr,
+    run_fill_listener,
+    run_stats_flusher,
+    unflushed,
     STAT_API,
     STAT_HITS,
     STAT_MISSES,
+    STATS_KEY,
     redis_ok,
     r,
 )
-from provider_openmeteo import get_weather_by_city, current_weather
+import provider_openmeteo
+from provider_openmeteo import get_weather_by_city, current_weather, HTTP_TIMEOUT
 
-app = FastAPI(title="Weather + Redis Cache Service", version="1.1.1")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flusher = asyncio.create_task(run_stats_flusher())
+    listener = asyncio.create_task(run_fill_listener())
+    if WARM_CITIES:
+        await warm_many(WARM_CITIES)
+    yield
+    for task in (listener, flusher):
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await flush_stats()  # whatever the flusher hadn't sent yet
+    await provider_openmeteo.aclose()
+
+app = FastAPI(title="Weather + Redis Cache Service", version="1.1.1",
+              default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # ---- Config ----
 FRESH_TTL = int(os.getenv("WEATHER_TTL", "300"))
 STALE_TTL = 24 * 3600
+# A fill is at most geocode + forecast, each bounded by HTTP_TIMEOUT (timeouts
+# come back as None, so they are never retried). Waiters are woken as soon as
+# the fill succeeds or fails; the TTL only bounds the wait if the holder dies.
+LOCK_TTL = math.ceil(2 * HTTP_TIMEOUT)
+WARM_CITIES = [c.strip() for c in os.getenv("WARM_CITIES", "").split(",") if c.strip()]
 
 # ---- Cache keys ----
 def weather_key(city: str) -> str:
@@ -39,9 +69,9 @@ def weather_stale_key(city: str) -> str:
     return f"weather:v1:stale:{city.strip().lower()}"
 
 # ---- Cached city fetch (counts upstream calls on miss) ----
-@cached(ttl=FRESH_TTL, lock_ttl=5, jitter_max=30, make_key=weather_key)
+@cached(ttl=FRESH_TTL, lock_ttl=LOCK_TTL, jitter_max=30, make_key=weather_key, raw=True)
 async def _fetch_weather_city(city: str):
-    await incr(STAT_API)  # only on real upstream call
+    incr(STAT_API)  # only on real upstream call
     data = await get_weather_by_city(city)
     if data is None:
         # serve stale if available
@@ -54,6 +84,18 @@ async def _fetch_weather_city(city: str):
     await cache_set(weather_stale_key(city), data, STALE_TTL)
     return data
 
+async def _warm_one(city: str) -> None:
+    try:
+        await _fetch_weather_city(city)
+    except HTTPException:
+        pass  # upstream down; city is fetched on first request instead
+
+async def warm_many(cities: list[str]) -> None:
+    """Fetch many cities concurrently so they start out as cache hits."""
+    async with asyncio.TaskGroup() as tg:
+        for city in cities:
+            tg.create_task(_warm_one(city))
+
 # ---- Endpoints ----
 @app.get("/weather")
 async def weather(
@@ -63,20 +105,18 @@ async def weather(
     Get weather for a city.
     Example: ?city=San%20Jose
     """
-    result = await _fetch_weather_city(city)
-    return JSONResponse(result)
+    # cached JSON document is sent as-is; no decode/re-encode on hits
+    body = await _fetch_weather_city(city)
+    return Response(content=body, media_type="application/json")
 
 @app.get("/stats")
 async def stats():
-    pipe = r.pipeline()
-    pipe.get(STAT_HITS)
-    pipe.get(STAT_MISSES)
-    pipe.get(STAT_API)
-    hits, misses, api_calls = await pipe.execute()
+    hits, misses, api_calls = await r.hmget(STATS_KEY, STAT_HITS, STAT_MISSES, STAT_API)
 
-    hits = int(hits or 0)
-    misses = int(misses or 0)
-    api_calls = int(api_calls or 0)
+    # add this worker's not-yet-flushed counts
+    hits = int(hits or 0) + unflushed(STAT_HITS)
+    misses = int(misses or 0) + unflushed(STAT_MISSES)
+    api_calls = int(api_calls or 0) + unflushed(STAT_API)
     return {
         "cache_hits": hits,
         "cache_misses": misses,
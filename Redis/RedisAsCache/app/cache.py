@@ -2,134 +2,354 @@
 # Async Redis cache with TTL+jitter, dogpile protection, and stats counters.
 
 import os
-import json
 import random
-import time
 import asyncio
 import functools
 import inspect
+import uuid
+from collections import Counter
 from typing import Any, Optional, Callable, Awaitable
 
+import orjson
 import redis.asyncio as redis
 from redis.exceptions import ConnectionError, TimeoutError, BusyLoadingError
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-_pool = redis.ConnectionPool.from_url(
+# Blocking pool: under a spike, callers queue up to REDIS_POOL_TIMEOUT for a
+# free connection instead of failing with "Too many connections".
+_pool = redis.BlockingConnectionPool.from_url(
     REDIS_URL,
     max_connections=int(os.getenv("REDIS_POOL_MAX", "200")),
+    timeout=float(os.getenv("REDIS_POOL_TIMEOUT", "0.5")),
     socket_connect_timeout=1.0,
     socket_timeout=1.5,
+    socket_keepalive=True,
     health_check_interval=30,
     retry_on_timeout=True,
 )
-r = redis.Redis(connection_pool=_pool, decode_responses=True)
+r = redis.Redis(connection_pool=_pool)  # replies stay bytes; orjson parses them directly
 
-STAT_HITS   = "stats:cache_hits"
-STAT_MISSES = "stats:cache_misses"
-STAT_API    = "stats:api_calls"
+# All counters live as fields of one hash so /stats is a single HMGET
+STATS_KEY   = "stats:cache"
+STAT_HITS   = "cache_hits"
+STAT_MISSES = "cache_misses"
+STAT_API    = "api_calls"
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_MS", "500")) / 1000
 
-async def incr(key: str, by: int = 1) -> None:
+# Counters are aggregated per process and flushed to STATS_KEY periodically,
+# so counting costs no Redis round-trip on the request path.
+_local: Counter = Counter()
+
+def incr(field: str, by: int = 1) -> None:
+    _local[field] += by
+
+def unflushed(field: str) -> int:
+    return _local[field]
+
+async def flush_stats() -> None:
+    if not _local:
+        return
+    pending = _local.copy()
+    _local.clear()
     try:
-        await r.incrby(key, by)
+        pipe = r.pipeline(transaction=False)
+        for field, n in pending.items():
+            pipe.hincrby(STATS_KEY, field, n)
+        await pipe.execute()
     except Exception:
-        pass  # fail-open
+        _local.update(pending)  # keep them for the next flush
+    except BaseException:
+        _local.update(pending)  # cancelled mid-flush: keep them for the final flush
+        raise
 
-def _dump(v: Any) -> str:
-    return json.dumps(v, separators=(",", ":"), ensure_ascii=False)
+async def run_stats_flusher(interval: float = STATS_FLUSH_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await flush_stats()
 
-def _load(s: Optional[str]) -> Any:
-    return None if s is None else json.loads(s)
+def _dump(v: Any) -> bytes:
+    return orjson.dumps(v)
 
-async def cache_get(key: str) -> Optional[Any]:
+def _load(s: Optional[bytes]) -> Any:
+    return None if s is None else orjson.loads(s)
+
+async def cache_get_raw(key: str) -> Optional[bytes]:
     try:
-        raw = await r.get(key)
-        return _load(raw)
+        return await r.get(key)
     except (ConnectionError, TimeoutError, BusyLoadingError):
         return None
 
+async def cache_get(key: str) -> Optional[Any]:
+    return _load(await cache_get_raw(key))
+
+async def cache_set_raw(key: str, payload: bytes, ttl: int) -> None:
+    try:
+        await r.setex(key, ttl, payload)
+    except (ConnectionError, TimeoutError, BusyLoadingError):
+        pass
+
 async def cache_set(key: str, value: Any, ttl: int) -> None:
+    await cache_set_raw(key, _dump(value), ttl)
+
+# Atomic lookup: returns {value, 0} on hit, or {nil, got_lock} on miss.
+# KEYS: value, lock   ARGV: lock ttl (s), lock token
+_GET_OR_LOCK = r.register_script("""
+local v = redis.call('GET', KEYS[1])
+if v then
+    return {v, 0}
+end
+local ok = redis.call('SET', KEYS[2], ARGV[2], 'NX', 'EX', ARGV[1])
+return {false, ok and 1 or 0}
+""")
+
+# Delete the lock only if we still own it (it may have expired and been re-taken)
+_RELEASE_LOCK = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+async def _get_or_lock(key: str, lock_key: str, lock_ttl: int,
+                       token: str) -> tuple[Optional[bytes], bool]:
+    try:
+        val, got_lock = await _GET_OR_LOCK(
+            keys=[key, lock_key], args=[lock_ttl, token])
+        return val, bool(got_lock)
+    except Exception:
+        return None, False  # fail-open
+
+async def _release_lock(lock_key: str, token: str) -> None:
+    try:
+        await _RELEASE_LOCK(keys=[lock_key], args=[token])
+    except Exception:
+        pass
+
+NOTIFY_PREFIX = "__notify__:"
+
+def _notify_channel(key: str) -> str:
+    return f"{NOTIFY_PREFIX}{key}"
+
+# One pattern subscription per process fans fill notifications out to local
+# waiters, so waiting holds no pooled connection. key -> Event set on fill.
+_fill_events: dict[str, asyncio.Event] = {}
+_fill_waiting: Counter = Counter()
+
+def _wake(key: str) -> None:
+    ev = _fill_events.pop(key, None)
+    if ev is not None:
+        ev.set()
+
+async def _wake_filled() -> None:
+    """Wake waiters whose key was filled while we weren't subscribed (one MGET)."""
+    keys = list(_fill_events)
+    if keys:
+        for key, v in zip(keys, await r.mget(keys)):
+            if v is not None:
+                _wake(key)
+
+async def run_fill_listener() -> None:
+    while True:
+        pubsub = r.pubsub()
+        try:
+            await pubsub.psubscribe(f"{NOTIFY_PREFIX}*")
+            await _wake_filled()
+            while True:
+                # Poll with our own timeout (below socket_timeout): an idle read
+                # returns None instead of dropping the subscription, which
+                # would lose any PUBLISH sent while re-subscribing.
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if msg is not None and msg["type"] == "pmessage":
+                    _wake(msg["channel"].decode()[len(NOTIFY_PREFIX):])
+        except Exception:
+            await asyncio.sleep(0.1)  # re-subscribe, then resync parked waiters
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+async def _fill(key: str, payload: bytes, ttl: int) -> None:
+    """Store a freshly computed value and wake any waiters, in one round-trip."""
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.setex(key, ttl, payload)
+        pipe.publish(_notify_channel(key), "1")
+        await pipe.execute()
+    except (ConnectionError, TimeoutError, BusyLoadingError):
+        pass
+
+async def _fill_failed(key: str) -> None:
+    """Wake waiters without a value, so they compute now instead of after lock_ttl."""
     try:
-        await r.setex(key, ttl, _dump(value))
+        await r.publish(_notify_channel(key), "0")
     except (ConnectionError, TimeoutError, BusyLoadingError):
         pass
 
+async def _wait_for_fill(key: str, timeout: float) -> Optional[bytes]:
+    """Block until the lock holder publishes `key` (or timeout); return its value."""
+    ev = _fill_events.get(key)
+    if ev is None:
+        ev = _fill_events[key] = asyncio.Event()
+    _fill_waiting[key] += 1
+    try:
+        # registered before this GET, so a fill after it can't be missed
+        hit = await cache_get_raw(key)
+        if hit is None:
+            await asyncio.wait_for(ev.wait(), timeout)
+            hit = await cache_get_raw(key)
+        return hit
+    except asyncio.TimeoutError:
+        return None  # caller computes
+    finally:
+        _fill_waiting[key] -= 1
+        if not _fill_waiting[key]:
+            del _fill_waiting[key]
+            if _fill_events.get(key) is ev:
+                del _fill_events[key]
+
 async def cache_delete(key: str) -> None:
     try:
         await r.delete(key)
     except Exception:
         pass
 
+def _lock_key(key: str) -> str:
+    return f"__lock__:{key}"
+
+async def _lookup(key: str, lock_ttl: int) -> tuple[Optional[bytes], Optional[str]]:
+    """
+    Return (value, None) on a hit, waiting out another caller's fill if needed;
+    otherwise (None, token) and the caller computes. token is the lock token
+    if the caller holds the lock, else None.
+    """
+    token = uuid.uuid4().hex
+    # GET and NX lock in one atomic RTT
+    hit, got_lock = await _get_or_lock(key, _lock_key(key), lock_ttl, token)
+    if hit is not None:
+        incr(STAT_HITS)
+        return hit, None
+    incr(STAT_MISSES)
+
+    if not got_lock:
+        token = None
+        hit = await _wait_for_fill(key, lock_ttl)
+    if hit is None:
+        hit = await cache_get_raw(key)  # double-check
+    if hit is not None:
+        incr(STAT_HITS)
+        if token:
+            await _release_lock(_lock_key(key), token)
+        return hit, None
+    return None, token
+
+async def _store(key: str, token: Optional[str], payload: bytes, ttl: int) -> None:
+    try:
+        await _fill(key, payload, ttl)
+    finally:
+        if token:
+            await _release_lock(_lock_key(key), token)
+
+async def _abandon(key: str, token: Optional[str]) -> None:
+    """Compute failed: wake waiters now and drop the lock if we hold it."""
+    if token:
+        await _fill_failed(key)
+        await _release_lock(_lock_key(key), token)
+
 def cached(
     ttl: int = 300,
     namespace: str = "",
     lock_ttl: int = 5,
     jitter_max: int = 30,
     make_key: Callable[..., str] | None = None,
+    raw: bool = False,
 ):
     """
     Async-aware cache-aside decorator with:
       - TTL + jitter
-      - dogpile protection via NX lock
-      - global hit/miss counters in Redis
+      - dogpile protection via token-owned NX lock; waiters are woken via pub/sub
+      - hit/miss counters (aggregated locally, flushed to Redis)
+    With raw=True the wrapper returns the stored JSON document instead of
+    decoding it, so callers can send it on without re-encoding.
     """
     def decorator(fn: Callable[..., Any | Awaitable[Any]]):
         is_async = inspect.iscoroutinefunction(fn)
 
-        @functools.wraps(fn)
-        async def async_wrapper(*args, **kwargs):
-            key_base = (make_key(*args, **kwargs) if make_key
-                        else f"{fn.__module__}.{fn.__name__}:{args}:{sorted(kwargs.items())}")
-            key = f"{namespace}:{key_base}" if namespace else key_base
-            lock_key = f"__lock__:{key}"
-
-            # fast path
-            val = await cache_get(key)
-            if val is not None:
-                await incr(STAT_HITS)
-                return val
-
-            await incr(STAT_MISSES)
-
-            # acquire short lock
-            got_lock = False
-            try:
-                got_lock = await r.set(lock_key, "1", nx=True, ex=lock_ttl) or False
-            except Exception:
-                pass
+        if make_key is not None and not namespace:
+            key_of = make_key
+        else:
+            base = make_key or (lambda *args, **kwargs:
+                                f"{fn.__module__}.{fn.__name__}:{args}:{sorted(kwargs.items())}")
+            prefix = f"{namespace}:" if namespace else ""
+            def key_of(*args, **kwargs):
+                return prefix + base(*args, **kwargs)
 
-            if not got_lock:
-                deadline = time.time() + lock_ttl
-                while time.time() < deadline:
-                    await asyncio.sleep(0.02)
-                    val = await cache_get(key)
-                    if val is not None:
-                        await incr(STAT_HITS)
-                        return val
-                # fall through to compute
-
-            try:
-                # double-check
-                val = await cache_get(key)
-                if val is not None:
-                    await incr(STAT_HITS)
-                    return val
-
-                result = await fn(*args, **kwargs) if is_async else fn(*args, **kwargs)
-                ttl_with_jitter = ttl + random.randint(0, jitter_max)
-                await cache_set(key, result, ttl_with_jitter)
+        # One specialized wrapper per (async, raw) combination, picked here at
+        # decoration time, so a call never branches on either or awaits a
+        # plain function.
+        if is_async and raw:
+            async def async_wrapper(*args, **kwargs):
+                key = key_of(*args, **kwargs)
+                hit, token = await _lookup(key, lock_ttl)
+                if hit is not None:
+                    return hit
+                try:
+                    payload = _dump(await fn(*args, **kwargs))
+                except BaseException:
+                    await _abandon(key, token)
+                    raise
+                await _store(key, token, payload, ttl + random.randint(0, jitter_max))
+                return payload
+        elif is_async:
+            async def async_wrapper(*args, **kwargs):
+                key = key_of(*args, **kwargs)
+                hit, token = await _lookup(key, lock_ttl)
+                if hit is not None:
+                    return _load(hit)
+                try:
+                    result = await fn(*args, **kwargs)
+                    payload = _dump(result)
+                except BaseException:
+                    await _abandon(key, token)
+                    raise
+                await _store(key, token, payload, ttl + random.randint(0, jitter_max))
+                return result
+        elif raw:
+            async def async_wrapper(*args, **kwargs):
+                key = key_of(*args, **kwargs)
+                hit, token = await _lookup(key, lock_ttl)
+                if hit is not None:
+                    return hit
+                try:
+                    payload = _dump(fn(*args, **kwargs))
+                except BaseException:
+                    await _abandon(key, token)
+                    raise
+                await _store(key, token, payload, ttl + random.randint(0, jitter_max))
+                return payload
+        else:
+            async def async_wrapper(*args, **kwargs):
+                key = key_of(*args, **kwargs)
+                hit, token = await _lookup(key, lock_ttl)
+                if hit is not None:
+                    return _load(hit)
+                try:
+                    result = fn(*args, **kwargs)
+                    payload = _dump(result)
+                except BaseException:
+                    await _abandon(key, token)
+                    raise
+                await _store(key, token, payload, ttl + random.randint(0, jitter_max))
                 return result
-            finally:
-                if got_lock:
-                    try:
-                        await r.delete(lock_key)
-                    except Exception:
-                        pass
 
+        if is_async:
+            return functools.wraps(fn)(async_wrapper)
+
+        @functools.wraps(fn)
         def sync_wrapper(*args, **kwargs):
             return asyncio.run(async_wrapper(*args, **kwargs))
-
-        return async_wrapper if is_async else sync_wrapper
+        return sync_wrapper
     return decorator
 
 async def redis_ok() -> bool:
@@ -5,7 +5,20 @@ from typing import Dict, Any, Optional
 import httpx
 import asyncio
 
+from cache import cache_get, cache_set
+
 HTTP_TIMEOUT = 2.0
+GEOCODE_TTL = 7 * 24 * 3600  # city -> coords is effectively static
+
+# Shared client: keeps TLS/HTTP2 connections to Open-Meteo warm across requests
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+)
+
+async def aclose() -> None:
+    await _client.aclose()
 
 async def _get_json(client: httpx.AsyncClient, url: str, params: dict) -> Optional[dict]:
     try:
@@ -26,6 +39,20 @@ async def geocode_city(client: httpx.AsyncClient, city: str) -> Optional[Dict[st
     top = data["results"][0]
     return {"lat": top["latitude"], "lon": top["longitude"], "name": top["name"], "country": top.get("country_code")}
 
+def geocode_key(city: str) -> str:
+    return f"geo:v1:{city.strip().lower()}"
+
+async def geocode_cached(city: str) -> Optional[Dict[str, float]]:
+    """Geocode via Redis first so weather misses only pay for the forecast call."""
+    key = geocode_key(city)
+    loc = await cache_get(key)
+    if loc is not None:
+        return loc
+    loc = await geocode_city(_client, city)
+    if loc:
+        await cache_set(key, loc, GEOCODE_TTL)
+    return loc
+
 async def current_weather(client: httpx.AsyncClient, lat: float, lon: float) -> Optional[Dict[str, Any]]:
     data = await _get_json(
         client,
@@ -46,16 +73,15 @@ async def current_weather(client: httpx.AsyncClient, lat: float, lon: float) ->
 async def get_weather_by_city(city: str) -> Optional[Dict[str, Any]]:
     for attempt in range(2):
         try:
-            async with httpx.AsyncClient(http2=True) as client:
-                loc = await geocode_city(client, city)
-                if not loc:
-                    return None
-                cw = await current_weather(client, loc["lat"], loc["lon"])
-                if not cw:
-                    return None
-                cw["city"] = loc["name"]
-                cw["country"] = loc.get("country")
-                return cw
+            loc = await geocode_cached(city)
+            if not loc:
+                return None
+            cw = await current_weather(_client, loc["lat"], loc["lon"])
+            if not cw:
+                return None
+            cw["city"] = loc["name"]
+            cw["country"] = loc.get("country")
+            return cw
         except Exception:
             if attempt == 1:
                 return None
@@ -1,12 +1,13 @@
 from typing import Optional, List
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from models import POIUpsert, POIResult
-from geo_store import upsert_poi, delete_poi, get_poi, nearby, redis_ok, stats
+from geo_store import upsert_poi, upsert_many, delete_poi, get_poi, nearby, redis_ok, stats
 
-app = FastAPI(title="Redis GEO Proximity Service", version="1.0.1")
+app = FastAPI(title="Redis GEO Proximity Service", version="1.0.1",
+              default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,25 +28,34 @@ async def healthz():
 async def create_or_update_poi(poi: POIUpsert):
     try:
         pid = await upsert_poi(poi.model_dump())
-        return JSONResponse({"id": pid, "ok": True})
+        return {"id": pid, "ok": True}
     except Exception as e:
         # include message for visibility
         raise HTTPException(status_code=500, detail=f"upsert_failed:{type(e).__name__}:{e}")
 
+@app.post("/poi/bulk")
+async def create_or_update_pois(pois: List[POIUpsert]):
+    try:
+        pids = await upsert_many([p.model_dump() for p in pois])
+        return {"ids": pids, "ok": True}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"bulk_upsert_failed:{type(e).__name__}:{e}")
+
 @app.get("/poi/nearby", response_model=List[POIResult])
 async def poi_nearby(
     lat: float = Query(...),
     lon: float = Query(...),
     radius_km: float = Query(5.0, gt=0),
     limit: int = Query(20, gt=0, le=200),
+    offset: int = Query(0, ge=0, le=1000),
     category: Optional[str] = Query(None),
     tag: Optional[str] = Query(None),
 ):
     try:
-        res = await nearby(lat=lat, lon=lon, radius_km=radius_km, limit=limit,
-                           category=category, tag=tag)
-        # Always return a JSON array (never None)
-        return res or []
+        body = await nearby(lat=lat, lon=lon, radius_km=radius_km, limit=limit,
+                            category=category, tag=tag, offset=offset)
+        # Already-encoded JSON array (cached bytes on a hit); sent as-is
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"nearby_failed:{type(e).__name__}")
 
@@ -60,7 +70,7 @@ async def read_poi(poi_id: str):
 @app.delete("/poi/{poi_id}")
 async def remove_poi(poi_id: str):
     await delete_poi(poi_id)
-    return JSONResponse({"ok": True})
+    return {"ok": True}
 
 @app.get("/stats")
 async def get_stats():
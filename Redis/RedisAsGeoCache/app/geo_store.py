@@ -1,59 +1,66 @@
-import os, json, random
+import os, random, logging
 from typing import Optional, List, Dict, Tuple
+from uuid import uuid4
+import orjson
 import redis.asyncio as redis
 
+log = logging.getLogger(__name__)
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", "30"))
 TMP_TTL   = int(os.getenv("GEO_TMP_TTL", "5"))
 QUERY_QUANT = float(os.getenv("GEO_QUERY_QUANT", "0.0005"))
+_INV_Q      = 1.0 / QUERY_QUANT
 
 GEO_KEY         = "poi:geo"
-POI_HASH        = "poi:{id}"
+POI_HASH        = "poi:{id}"           # legacy per-POI hash; read once to migrate, never written
+POI_JSON        = "poi:json:{id}"
 TAG_SET         = "poi:tag:{tag}"
 CAT_SET         = "poi:cat:{cat}"
-CACHE_NEARBY    = "poi:cache:nearby:{lat},{lon}:{r}:{lim}:{cat}:{tag}"
-STAT_QUERIES    = "stats:geo:queries"
-STAT_CACHE_HIT  = "stats:geo:cache_hits"
-STAT_CACHE_MISS = "stats:geo:cache_misses"
-STAT_WRITES     = "stats:geo:writes"
-STAT_SCANNED    = "stats:geo:candidates_scanned"
-
-_pool = redis.ConnectionPool.from_url(
+STATS_KEY       = "stats:geo"          # hash; fields below
+STAT_QUERIES    = "queries"
+STAT_CACHE_HIT  = "cache_hits"
+STAT_CACHE_MISS = "cache_misses"
+STAT_WRITES     = "writes"
+STAT_SCANNED    = "candidates_scanned"
+
+# Blocking pool: under a spike, callers queue up to REDIS_POOL_TIMEOUT for a
+# free connection instead of failing with "Too many connections".
+_pool = redis.BlockingConnectionPool.from_url(
     REDIS_URL,
     max_connections=int(os.getenv("REDIS_POOL_MAX", "300")),
+    timeout=float(os.getenv("REDIS_POOL_TIMEOUT", "0.5")),
     socket_connect_timeout=1.0,
     socket_timeout=1.5,
+    socket_keepalive=True,
     health_check_interval=30,
     retry_on_timeout=True,
 )
-r = redis.Redis(connection_pool=_pool, decode_responses=True)
+r = redis.Redis(connection_pool=_pool)  # replies stay bytes; orjson parses them directly
 
-def _dump(x): return json.dumps(x, separators=(",", ":"), ensure_ascii=False)
-def _load(s): return None if s is None else json.loads(s)
+def _dump(x): return orjson.dumps(x)
+def _load(s): return None if s is None else orjson.loads(s)
 def _jitter(ttl: int, max_j: int = 20) -> int: return ttl + random.randint(0, 2)
 
 def _q(v: float) -> float:
-    q = QUERY_QUANT
-    return round(round(v / q) * q, 6)
+    return round(round(v * _INV_Q) * QUERY_QUANT, 6)
 
 def _cache_key(lat: float, lon: float, radius_km: float, limit: int,
-               category: Optional[str], tag: Optional[str]) -> str:
-    return CACHE_NEARBY.format(
-        lat=f"{_q(lat):.6f}", lon=f"{_q(lon):.6f}",
-        r=f"{radius_km:.2f}", lim=limit,
-        cat=(category or "_"), tag=(tag or "_")
-    )
-
-async def incr(key: str, by: int = 1):
+               category: Optional[str], tag: Optional[str], offset: int = 0) -> str:
+    # poi:cache:nearby:{lat},{lon}:{r}:{lim}@{off}:{cat}:{tag} -- f-string, no per-call template parse
+    return (f"poi:cache:nearby:{_q(lat):.6f},{_q(lon):.6f}:{radius_km:.2f}:{limit}@{offset}"
+            f":{category or '_'}:{tag or '_'}")
+
+async def incr(field: str, by: int = 1):
     try:
-        await r.incrby(key, by)
+        await r.hincrby(STATS_KEY, field, by)
     except Exception:
         pass
 
 # ----------------- Core writes -----------------
 
-async def upsert_poi(poi: Dict) -> str:
+def _queue_upsert(pipe, poi: Dict) -> str:
     pid = poi["id"]                    # you’re supplying this from Locust
     lat, lon = float(poi["lat"]), float(poi["lon"])
     tags = poi.get("tags") or []
@@ -62,156 +69,151 @@ async def upsert_poi(poi: Dict) -> str:
     if not (-85.05112878 <= lat <= 85.05112878): raise ValueError("lat out of range")
     if not (-180.0 <= lon <= 180.0): raise ValueError("lon out of range")
 
-    pipe = r.pipeline()
+    metadata = poi.get("metadata") or {}
     # Use CH so you can tell if it actually moved (changed=1) or was identical (0)
     pipe.execute_command("GEOADD", GEO_KEY, "CH", lon, lat, pid)
-    pipe.hset(POI_HASH.format(id=pid), mapping={
-        "name": poi["name"], "lat": lat, "lon": lon,
-        "category": cat or "", "tags": _dump(tags),
-        "metadata": _dump(poi.get("metadata") or {})
-    })
+    # Full document as one value so reads can MGET many POIs in one command.
+    # POIs stored before poi:json existed only have the legacy hash; reads
+    # migrate them on first touch (_migrate_legacy).
+    pipe.set(POI_JSON.format(id=pid), _dump({
+        "id": pid, "name": poi["name"], "lat": lat, "lon": lon,
+        "category": cat or None, "tags": tags, "metadata": metadata,
+    }))
     if cat: pipe.sadd(CAT_SET.format(cat=cat), pid)
     for t in tags: pipe.sadd(TAG_SET.format(tag=t), pid)
+    return pid
+
+async def upsert_poi(poi: Dict) -> str:
+    pipe = r.pipeline()
+    pid = _queue_upsert(pipe, poi)
     changed, *_ = await pipe.execute()   # changed is 1 if coord updated or new, 0 if same
     await incr(STAT_WRITES)
     return pid
 
+async def upsert_many(pois: List[Dict]) -> List[str]:
+    """Upsert a batch of POIs in one pipeline (one round-trip)."""
+    pipe = r.pipeline()
+    pids = [_queue_upsert(pipe, poi) for poi in pois]  # validates all before sending
+    await pipe.execute()
+    await incr(STAT_WRITES, by=len(pids))
+    return pids
+
 
 async def delete_poi(pid: str):
     pipe = r.pipeline()
     pipe.zrem(GEO_KEY, pid)
-    pipe.delete(POI_HASH.format(id=pid))
+    pipe.delete(POI_HASH.format(id=pid), POI_JSON.format(id=pid))
     await pipe.execute()
 
+async def _migrate_legacy(pids: List[str]) -> Dict[str, Dict]:
+    """
+    Read fallback for POIs stored before poi:json existed: load their legacy
+    hashes, write the JSON document back, and return the docs by id. Each POI
+    goes through here at most once.
+    """
+    pipe = r.pipeline(transaction=False)
+    for pid in pids:
+        pipe.hgetall(POI_HASH.format(id=pid))
+    rows = await pipe.execute(raise_on_error=False)
+
+    docs: Dict[str, Dict] = {}
+    pipe = r.pipeline(transaction=False)
+    for pid, h in zip(pids, rows):
+        if not h or isinstance(h, Exception):
+            continue
+        doc = {
+            "id": pid, "name": h[b"name"].decode(),
+            "lat": float(h[b"lat"]), "lon": float(h[b"lon"]),
+            "category": h.get(b"category", b"").decode() or None,
+            "tags": _load(h.get(b"tags")) or [],
+            "metadata": _load(h.get(b"metadata")) or {},
+        }
+        pipe.set(POI_JSON.format(id=pid), _dump(doc), nx=True)
+        docs[pid] = doc
+    if docs:
+        await pipe.execute()
+        log.info("migrated %d legacy POI hash(es) to poi:json", len(docs))
+    return docs
+
 async def get_poi(pid: str) -> Optional[Dict]:
-    hash_key = POI_HASH.format(id=pid)
-    print(f"DEBUG: Getting POI with key: {hash_key}")
-    h = await r.hgetall(hash_key)
-    print(f"DEBUG: hgetall returned: {h}")
-    print(f"DEBUG: Type of h: {type(h)}")
-    if not h:
-        print("DEBUG: Hash is empty, returning None")
-        return None
-    h = { (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v) for k, v in h.items() }
-    print(f"DEBUG: lat value: {h.get('lat')} (type: {type(h.get('lat'))})")
-    print(f"DEBUG: lon value: {h.get('lon')} (type: {type(h.get('lon'))})")
-    
-    return {
-        "id": pid,
-        "name": h.get("name"),
-        "lat": float(h.get("lat")),
-        "lon": float(h.get("lon")),
-        "category": (h.get("category") or "") or None,
-        "tags": _load(h.get("tags") or "[]"),
-        "metadata": _load(h.get("metadata") or "{}"),
-    }
+    poi = _load(await r.get(POI_JSON.format(id=pid)))
+    if poi is None:
+        poi = (await _migrate_legacy([pid])).get(pid)
+    if poi is None:
+        log.debug("get_poi: %s not found", pid)
+    return poi
 
 # ----------------- GEO query -----------------
 
 async def _geosearch_candidates(lat: float, lon: float, radius_km: float, count: int):
     """
-    Use GEOSEARCH (Redis 6.2+) via redis-py. Normalize results across RESP2/RESP3
-    and redis-py versions. Fallback to GEORADIUS on any exception.
-    Returns list of (member:str, dist_km:float) sorted ASC by distance.
+    GEOSEARCHSTORE ... STOREDIST into a temp key, ZRANGE WITHSCORES, then DEL,
+    in one pipeline. The stored scores are distances in km, so rows come back
+    already as (member, dist_km) sorted ASC by distance.
     """
-    try:
-        rows = await r.geosearch(
-            GEO_KEY,
-            fromlonlat=(lon, lat),
-            byradius=(radius_km, "km"),
-            withdist=True,
-            sort="ASC",
-            count=count,
-        )
-        out: list[tuple[str, float]] = []
-        for row in (rows or []):
-            member = None
-            dist = None
-            if isinstance(row, (list, tuple)) and len(row) >= 2:
-                member, dist = row[0], row[1]
-            elif isinstance(row, dict):  # RESP3 style
-                member = row.get("member") or row.get(b"member")
-                dist = row.get("dist") or row.get(b"dist")
-            else:
-                continue
-            if isinstance(member, bytes):
-                member = member.decode()
-            out.append((member, float(dist)))
-        return out
-    except Exception:
-        rows = await r.execute_command(
-            "GEORADIUS", GEO_KEY, lon, lat, radius_km, "km", "WITHDIST", "ASC", "COUNT", count
-        )
-        out: list[tuple[str, float]] = []
-        for row in (rows or []):
-            mid = row[0].decode() if isinstance(row[0], bytes) else row[0]
-            out.append((mid, float(row[1])))
-        return out
+    tmp = f"poi:geo:tmp:{uuid4().hex}"
+    pipe = r.pipeline(transaction=False)
+    pipe.execute_command("GEOSEARCHSTORE", tmp, GEO_KEY, "FROMLONLAT", lon, lat,
+                         "BYRADIUS", radius_km, "km", "ASC", "COUNT", count, "STOREDIST")
+    pipe.expire(tmp, TMP_TTL)          # safety net if the pipeline is cut short
+    pipe.zrange(tmp, 0, count - 1, withscores=True)
+    pipe.delete(tmp)
+    _, _, rows, _ = await pipe.execute()
+    return [(member.decode(), dist) for member, dist in rows]
 
 async def nearby(lat: float, lon: float, radius_km: float, limit: int,
-                 category: Optional[str] = None, tag: Optional[str] = None) -> List[Dict]:
+                 category: Optional[str] = None, tag: Optional[str] = None,
+                 offset: int = 0) -> bytes:
+    """
+    Return the result list as encoded JSON, exactly as cached in Redis.
+    GEOSEARCH has no SKIP, so a page at `offset` re-searches offset+limit
+    nearest candidates and slices.
+    """
     await incr(STAT_QUERIES)
-    ckey = _cache_key(lat, lon, radius_km, limit, category, tag)
-    print(f"DEBUG[nearby]: lat={lat} lon={lon} r_km={radius_km} limit={limit} cat={category} tag={tag}")
-    print(f"DEBUG[nearby]: cache_key={ckey}")
-    cached = _load(await r.get(ckey))
+    ckey = _cache_key(lat, lon, radius_km, limit, category, tag, offset)
+    log.debug("nearby: lat=%s lon=%s r_km=%s limit=%s offset=%s cat=%s tag=%s key=%s",
+              lat, lon, radius_km, limit, offset, category, tag, ckey)
+    cached = await r.get(ckey)
     if cached is not None:
         await incr(STAT_CACHE_HIT)
-        print(f"DEBUG[nearby]: cache HIT items={len(cached)}")
+        log.debug("nearby: cache HIT")
         return cached
 
     await incr(STAT_CACHE_MISS)
-    print("DEBUG[nearby]: cache MISS")
-    count_hint = max(limit * 5, limit + 20)
+    log.debug("nearby: cache MISS")
+    window = offset + limit
+    count_hint = max(window * 5, window + 20)
     candidates = await _geosearch_candidates(lat, lon, radius_km, count_hint)
-    print(f"DEBUG[nearby]: candidates_found={len(candidates)} (hint={count_hint})")
+    log.debug("nearby: candidates_found=%d (hint=%d)", len(candidates), count_hint)
     await incr(STAT_SCANNED, by=len(candidates))
 
-    filtered: List[Tuple[str, float]] = []
-    for mid, dist in candidates:
-        if category and not await r.sismember(CAT_SET.format(cat=category), mid):
-            continue
-        if tag and not await r.sismember(TAG_SET.format(tag=tag), mid):
-            continue
-        filtered.append((mid, dist))
-        if len(filtered) >= limit:
-            break
+    filtered: List[Tuple[str, float]] = candidates
+    if candidates and (category or tag):
+        # One SMISMEMBER per filter set, all in a single round-trip
+        mids = [mid for mid, _ in candidates]
+        pipe = r.pipeline(transaction=False)
+        if category: pipe.smismember(CAT_SET.format(cat=category), mids)
+        if tag: pipe.smismember(TAG_SET.format(tag=tag), mids)
+        flags = await pipe.execute()
+        filtered = [c for c, *ok in zip(candidates, *flags) if all(ok)]
+    filtered = filtered[offset:window]
 
     out: List[Dict] = []
     if filtered:
-        print(f"DEBUG[nearby]: filtered_count={len(filtered)}")
-        pipe = r.pipeline()
-        for mid, _ in filtered:
-            pipe.hgetall(POI_HASH.format(id=mid))
-        raw = await pipe.execute()
-        for (mid, dist), h in zip(filtered, raw):
-            if not h:
+        raw = await r.mget([POI_JSON.format(id=mid) for mid, _ in filtered])
+        missing = [mid for (mid, _), doc in zip(filtered, raw) if doc is None]
+        legacy = await _migrate_legacy(missing) if missing else {}
+        for (mid, dist), doc in zip(filtered, raw):
+            poi = _load(doc) if doc is not None else legacy.get(mid)
+            if poi is None:
                 continue
-            # Normalize keys and values to str consistently (handles bytes in either)
-            h = {
-                (k.decode() if isinstance(k, bytes) else k):
-                (v.decode() if isinstance(v, bytes) else v)
-                for k, v in h.items()
-            }
-            # Ensure member id is a str
-            if isinstance(mid, bytes):
-                mid = mid.decode()
-            out.append({
-                "id": mid,
-                "name": h.get("name"),
-                "lat": float(h.get("lat")),
-                "lon": float(h.get("lon")),
-                "category": (h.get("category") or "") or None,
-                "tags": _load(h.get("tags") or "[]"),
-                "metadata": _load(h.get("metadata") or "{}"),
-                "distance_km": round(dist, 3),
-            })
-    else:
-        print("DEBUG[nearby]: filtered_count=0")
-
-    await r.setex(ckey, _jitter(CACHE_TTL), _dump(out))
-    print(f"DEBUG[nearby]: returning items={len(out)} and cached for ~{CACHE_TTL}s (jittered)")
-    return out
+            poi["distance_km"] = round(dist, 3)
+            out.append(poi)
+
+    payload = _dump(out)
+    await r.setex(ckey, _jitter(CACHE_TTL), payload)
+    log.debug("nearby: returning items=%d, cached for ~%ss", len(out), CACHE_TTL)
+    return payload
 
 # ----------------- Health & Stats -----------------
 
@@ -223,13 +225,8 @@ async def redis_ok() -> bool:
         return False
 
 async def stats() -> Dict:
-    pipe = r.pipeline()
-    pipe.get(STAT_QUERIES)
-    pipe.get(STAT_CACHE_HIT)
-    pipe.get(STAT_CACHE_MISS)
-    pipe.get(STAT_WRITES)
-    pipe.get(STAT_SCANNED)
-    q, h, m, w, s = await pipe.execute()
+    q, h, m, w, s = await r.hmget(STATS_KEY, STAT_QUERIES, STAT_CACHE_HIT,
+                                  STAT_CACHE_MISS, STAT_WRITES, STAT_SCANNED)
     to_i = lambda x: int(x or 0)
     total = to_i(h) + to_i(m)
     return {
@@ -26,5 +26,6 @@ class NearbyQuery(BaseModel):
     lon: float
     radius_km: float = 5.0
     limit: int = 20
+    offset: int = 0
     category: Optional[str] = None
     tag: Optional[str] = None
@@ -1,18 +1,46 @@
 # locustfile.py
+#
+# One Locust process is bound to one core (GIL), so scale the load generator
+# across cores with one worker process per core:
+#   locust -f locustfile.py --processes -1 -u 2000 -r 200 --headless -H http://app:8000
+# Seeding is safe in every process: each user seeds only its own uniquely-named
+# drivers (POST /poi/bulk in on_start).
+
+# Patch before anything else imports socket/threading. Locust patches on its
+# own import, so this only runs when the file is imported some other way.
+from gevent import monkey
+if not monkey.is_module_patched("socket"):
+    monkey.patch_all()
+
 import os, random, uuid
-from locust import HttpUser, task, between
+from array import array
+from urllib.parse import urlencode
+import orjson
+from locust import task, constant_throughput
+from locust.contrib.fasthttp import FastHttpUser
 
 # ------------------- Config -------------------
 BASE_LAT = float(os.getenv("BASE_LAT", 37.3382))        # San Jose
 BASE_LON = float(os.getenv("BASE_LON", -121.8863))
 DRIVERS_PER_USER = int(os.getenv("DRIVERS_PER_USER", 20))
 UPDATE_BATCH = int(os.getenv("UPDATE_BATCH", 5))         # how many drivers to move per tick
-UPDATE_EVERY = (float(os.getenv("DRIVER_MIN_WAIT", 0.1)),
-                float(os.getenv("DRIVER_MAX_WAIT", 0.3)))
-SEARCH_EVERY = (float(os.getenv("DISP_MIN_WAIT", 0.5)),
-                float(os.getenv("DISP_MAX_WAIT", 1.5)))
+# Per-user task rate cap (constant_throughput). It is met only while a task
+# finishes in under 1/USER_TASKS_PER_SEC s; slower tasks get no wait and the
+# user falls behind, so offered load still drops as latency grows. Compare the
+# achieved rate against users x USER_TASKS_PER_SEC tasks/s: if it is lower, the
+# server is throttling the test (a move task sends UPDATE_BATCH POSTs, a
+# paginated search PAGES GETs, so these can run past 0.5s under load).
+USER_TASKS_PER_SEC = float(os.getenv("USER_TASKS_PER_SEC", 2))
 RADIUS_KM = float(os.getenv("SEARCH_RADIUS_KM", 10))
 LIMIT = int(os.getenv("SEARCH_LIMIT", 100))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 20))
+PAGES = int(os.getenv("PAGES", 4))                       # pages walked per paginated search
+
+# Fleet mix: weighted so searches exercise common and rare filter sets alike
+CATEGORY_WEIGHTS = {"driver": 0.7, "courier": 0.2, "shuttle": 0.1}
+TAG_WEIGHTS = {"available": 0.8, "busy": 0.2}
+CATEGORIES, CATEGORY_W = list(CATEGORY_WEIGHTS), list(CATEGORY_WEIGHTS.values())
+TAGS, TAG_W = list(TAG_WEIGHTS), list(TAG_WEIGHTS.values())
 
 # Movement tuning
 MAX_SPEED = float(os.getenv("MAX_SPEED_DEG", 0.001))     # ~100 m per tick near equator
@@ -35,87 +63,150 @@ def clamp(lat, lon):
     lon = max(min(lon, BASE_LON + LON_SPAN), BASE_LON - LON_SPAN)
     return lat, lon
 
-def make_payload(d):
-    return {
-        "id": d["id"],
-        "name": d["name"],
-        "lat": d["lat"],
-        "lon": d["lon"],
-        "category": "driver",           # keep lowercase, server normalizes
-        "tags": d["tags"],
-    }
-
-def new_driver(user_prefix: str):
-    # start near base with small random offset
-    lat = BASE_LAT + random.uniform(-LAT_SPAN * 0.2, LAT_SPAN * 0.2)
-    lon = BASE_LON + random.uniform(-LON_SPAN * 0.2, LON_SPAN * 0.2)
-    return {
-        "id": f"driver-{user_prefix}-{uuid.uuid4().hex[:8]}",
-        "name": f"driver-{user_prefix}",
-        "lat": lat,
-        "lon": lon,
-        "tags": ["available"],
-        "_dx": random.uniform(-MAX_SPEED, MAX_SPEED),
-        "_dy": random.uniform(-MAX_SPEED, MAX_SPEED),
-    }
-
-def move_driver(d):
-    if random.random() < TURN_PROB:
-        d["_dx"] = random.uniform(-MAX_SPEED, MAX_SPEED)
-        d["_dy"] = random.uniform(-MAX_SPEED, MAX_SPEED)
-    d["lat"] += d["_dy"]
-    d["lon"] += d["_dx"]
-    d["lat"], d["lon"] = clamp(d["lat"], d["lon"])
+# Request bodies are encoded once with orjson and sent as raw bytes, instead of
+# letting the client json.dumps() them per call; the constant part of the
+# search URL is urlencoded once at import, only lat/lon are filled per call.
+JSON_HEADERS = {"Content-Type": "application/json"}
+NEARBY_URL_TMPL = {
+    cat: "/poi/nearby?" + urlencode({
+        "radius_km": RADIUS_KM,
+        "limit": LIMIT,
+        "category": cat,
+    }) + "&lat={:.6f}&lon={:.6f}"
+    for cat in CATEGORIES
+}
+NEARBY_TAG_URL_TMPL = {
+    tag: "/poi/nearby?" + urlencode({
+        "radius_km": RADIUS_KM,
+        "limit": LIMIT,
+        "tag": tag,
+    }) + "&lat={:.6f}&lon={:.6f}"
+    for tag in TAGS
+}
+NEARBY_PAGE_URL_TMPL = "/poi/nearby?" + urlencode({
+    "radius_km": RADIUS_KM,
+    "limit": PAGE_SIZE,
+    "category": "driver",
+}) + "&offset={}&lat={:.6f}&lon={:.6f}"
+
+def random_point(rng: random.Random):
+    # anywhere in the fleet's bounding box, so searches spread over many
+    # geohash cells / cache keys instead of one hot one
+    return (rng.uniform(BASE_LAT - LAT_SPAN, BASE_LAT + LAT_SPAN),
+            rng.uniform(BASE_LON - LON_SPAN, BASE_LON + LON_SPAN))
+
+class Fleet:
+    """
+    One user's drivers as parallel arrays (struct-of-arrays): coordinates and
+    velocities live in contiguous array('d') buffers instead of one dict per
+    driver; driver i is index i in every column.
+    """
+    def __init__(self, user_prefix: str, n: int, rng: random.Random):
+        self.name = f"driver-{user_prefix}"
+        self.ids = [f"driver-{user_prefix}-{uuid.uuid4().hex[:8]}" for _ in range(n)]
+        # start near base with small random offset
+        self.lats = array("d", (BASE_LAT + rng.uniform(-LAT_SPAN * 0.2, LAT_SPAN * 0.2) for _ in range(n)))
+        self.lons = array("d", (BASE_LON + rng.uniform(-LON_SPAN * 0.2, LON_SPAN * 0.2) for _ in range(n)))
+        self.dx = array("d", (rng.uniform(-MAX_SPEED, MAX_SPEED) for _ in range(n)))
+        self.dy = array("d", (rng.uniform(-MAX_SPEED, MAX_SPEED) for _ in range(n)))
+        self.categories = [rng.choices(CATEGORIES, CATEGORY_W)[0] for _ in range(n)]
+        self.tags = [rng.choices(TAGS, TAG_W) for _ in range(n)]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def move(self, i: int, rng: random.Random):
+        if rng.random() < TURN_PROB:
+            self.dx[i] = rng.uniform(-MAX_SPEED, MAX_SPEED)
+            self.dy[i] = rng.uniform(-MAX_SPEED, MAX_SPEED)
+        self.lats[i], self.lons[i] = clamp(self.lats[i] + self.dy[i], self.lons[i] + self.dx[i])
+
+    def payload(self, i: int) -> dict:
+        return {
+            "id": self.ids[i],
+            "name": self.name,
+            "lat": self.lats[i],
+            "lon": self.lons[i],
+            "category": self.categories[i],
+            "tags": self.tags[i],
+        }
 
 print("[INIT] Locustfile loaded")
 
 # ------------------- Single user class (owns 20 drivers) -------------------
-class FleetUser(HttpUser):
-    # unify wait_time to cover both update & search cadences
-    wait_time = between(min(UPDATE_EVERY[0], SEARCH_EVERY[0]),
-                        max(UPDATE_EVERY[1], SEARCH_EVERY[1]))
+class FleetUser(FastHttpUser):
+    # default target inside the Compose network; -H/--host overrides it
+    host = "http://app:8000"
+
+    # geventhttpclient-backed client: C HTTP parser, persistent connections
+    network_timeout = 10.0
+    connection_timeout = 10.0
+    # FastHttpUser's defaults already fit: connections are kept alive and
+    # reused, and a user's tasks run one request at a time, so the default
+    # pool (concurrency=10) is never exhausted and there is nothing to tune.
+    # Failed requests are not retried (max_retries=0), so server errors and
+    # latency are reported as they happened.
+    # (No HTTP/2 client: uvicorn serves HTTP/1.1 only, so there is nothing to
+    # multiplex over; keep-alive reuse is the connection saving available.)
+
+    # at most USER_TASKS_PER_SEC tasks/s per user instead of think time; this
+    # is still closed-loop (see USER_TASKS_PER_SEC), so watch achieved RPS
+    wait_time = constant_throughput(USER_TASKS_PER_SEC)
+
+    # Response bodies are intentionally never read (.json()/.content) except on
+    # the move error path: stats come from status + timing, so the client can
+    # drop body buffers without decoding them. Keep it that way in new tasks.
 
     def on_start(self):
         # unique prefix per user (stable for user lifetime)
         self.user_prefix = uuid.uuid4().hex[:12]
+        # private PRNG per user: no shared module-level random state across greenlets
+        self.rng = random.Random()
         # create this user's fleet
-        self.drivers = [new_driver(self.user_prefix) for _ in range(DRIVERS_PER_USER)]
+        self.fleet = Fleet(self.user_prefix, DRIVERS_PER_USER, self.rng)
         self._cursor = 0
 
-        # seed all drivers owned by this user
-        ok = 0
-        for d in self.drivers:
-            r = self.client.post("/poi", json=make_payload(d), name="POST /poi (seed-per-user)")
-            if r.status_code < 300:
-                ok += 1
-        print(f"[SEED] base_url={self.client.base_url} | user={self.user_prefix} | seeded {ok}/{len(self.drivers)}")
+        # seed all drivers owned by this user in one request
+        n = len(self.fleet)
+        body = orjson.dumps([self.fleet.payload(i) for i in range(n)])
+        r = self.client.post("/poi/bulk", data=body, headers=JSON_HEADERS,
+                             name="POST /poi/bulk (seed-per-user)")
+        ok = n if r.status_code < 300 else 0
+        print(f"[SEED] base_url={self.client.base_url} | user={self.user_prefix} | seeded {ok}/{n}")
 
     @task(3)
     def move_some_drivers(self):
         # move a batch of drivers each tick (round-robin)
-        n = len(self.drivers)
+        n = len(self.fleet)
         if n == 0:
             return
         end = self._cursor + max(1, min(UPDATE_BATCH, n))
         for i in range(self._cursor, end):
-            d = self.drivers[i % n]
-            move_driver(d)
-            r = self.client.post("/poi", json=make_payload(d), name="POST /poi (move)")
+            self.fleet.move(i % n, self.rng)
+            r = self.client.post("/poi", data=orjson.dumps(self.fleet.payload(i % n)),
+                                 headers=JSON_HEADERS, name="POST /poi (move)")
             if r.status_code >= 300:
                 # simple error print; Locust will also record request failure
                 print(f"[MOVE][ERR] status={r.status_code} body={r.text[:160]}")
         self._cursor = end % n
 
     @task(1)
-    def nearby_search(self):
-        self.client.get(
-            "/poi/nearby",
-            params={
-                "lat": BASE_LAT,
-                "lon": BASE_LON,
-                "radius_km": RADIUS_KM,
-                "limit": LIMIT,
-                "category": "driver",
-            },
-            name="GET /poi/nearby (drivers)"
-        )
+    def search_filtered(self):
+        cat = self.rng.choices(CATEGORIES, CATEGORY_W)[0]
+        lat, lon = random_point(self.rng)
+        self.client.get(NEARBY_URL_TMPL[cat].format(lat, lon), name="GET /poi/nearby (category)")
+
+    @task(1)
+    def search_by_tag(self):
+        tag = self.rng.choices(TAGS, TAG_W)[0]
+        lat, lon = random_point(self.rng)
+        self.client.get(NEARBY_TAG_URL_TMPL[tag].format(lat, lon), name="GET /poi/nearby (tag)")
+
+    @task(1)
+    def search_paginated(self):
+        # walk several pages of one search; deep pages are the expensive case
+        # since the server re-searches offset+limit candidates every time
+        lat, lon = random_point(self.rng)
+        for offset in range(0, PAGES * PAGE_SIZE, PAGE_SIZE):
+            self.client.get(NEARBY_PAGE_URL_TMPL.format(offset, lat, lon),
+                            name="GET /poi/nearby [page]")